@@ -0,0 +1,51 @@
+# bench_historian_fanout.py
+# Measures /api/historian query time with the fan-out planner on vs off
+# (single statement), for increasing pen counts. Needs the real DB (.env).
+#   python bench_historian_fanout.py [days]
+import sys
+import time
+from datetime import datetime, timezone, timedelta
+
+import main_api
+from main_api import fetch_historian_rows, historian_bucket, plan_historian_query
+
+DAYS = float(sys.argv[1]) if len(sys.argv) > 1 else 7
+TAG_COUNTS = [1, 2, 4, 8, 12, 16]
+REPEAT = 3
+
+def timed(fn):
+    best, out = float("inf"), None
+    for _ in range(REPEAT):
+        t = time.perf_counter()
+        out = fn()
+        best = min(best, time.perf_counter() - t)
+    return out, best
+
+print("--- Historian Fan-out Benchmark ---")
+main_api.init_db_pool()
+conn = main_api.get_db_conn()
+try:
+    with conn.cursor() as cur:
+        cur.execute("SELECT tag FROM historian.tag_lookup ORDER BY id")
+        all_tags = [r[0] for r in cur.fetchall()]
+finally:
+    main_api.release_db_conn(conn)
+
+et = datetime.now(timezone.utc)
+st = et - timedelta(days=DAYS)
+buck = historian_bucket((et - st).total_seconds())
+print(f"Range: {DAYS} days, bucket={buck or 'raw'}, tags available={len(all_tags)}")
+print(f"{'tags':>5} {'subqueries':>11} {'rows':>9} {'single s':>9} {'fan-out s':>10} {'speedup':>8}")
+
+for n in TAG_COUNTS:
+    if n > len(all_tags): break
+    tags = all_tags[:n]
+    single, t_single = timed(lambda: fetch_historian_rows(tags, st, et, buck, fanout=False, deadline_s=600))
+    fanned, t_fan = timed(lambda: fetch_historian_rows(tags, st, et, buck, deadline_s=600))
+    assert sorted(single) == sorted(fanned), "fan-out returned different rows"
+    parts = len(plan_historian_query(tags, st, et, buck))
+    print(f"{n:>5} {parts:>11} {len(single):>9} {t_single:>9.3f} {t_fan:>10.3f} {t_single / t_fan:>7.2f}x")
+
+main_api.stop_event.set()
+main_api.pg_pool.closeall()
+print("--- Benchmark Complete ---")
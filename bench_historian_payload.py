@@ -0,0 +1,66 @@
+# bench_historian_payload.py
+# Compares the old /api/historian response (dict-per-row + stdlib json, which is
+# what FastAPI's default encoder does) with the orjson legacy / columnar paths,
+# for several raw range sizes. No database needed: rows are synthetic.
+#   python bench_historian_payload.py
+import json
+import gzip
+import random
+import time
+from datetime import datetime, timezone, timedelta
+
+from main_api import encode_historian, RESPONSE_CODECS
+
+TAGS = ["A25_Speed", "A25_Power", "A25_SoC", "A25_Energy_Total", "TT001.Scaled",
+        "TT002.Scaled", "TT003.Scaled", "VT001.Scaled", "A25_En_Charge", "A25_Status"]
+RANGES = [("30 min", 1800), ("6 hours", 6 * 3600), ("1 day", 86400), ("3 days", 3 * 86400)]
+REPEAT = 3
+
+def make_rows(seconds):
+    t0 = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    rows = []
+    for i in range(seconds):
+        ts = t0 + timedelta(seconds=i)
+        for t in TAGS:
+            rows.append((ts, t, float(random.random() < 0.5) if t == "A25_En_Charge" else random.uniform(0, 1000)))
+    return rows
+
+def old_encode(rows, tags):
+    res = {t: [] for t in tags}
+    for r in rows:
+        if r[2] is not None:
+            res[r[1]].append({"ts": r[0].isoformat(), "value": r[2]})
+    return json.dumps(res).encode()
+
+def timed(fn, *args):
+    best = float("inf")
+    for _ in range(REPEAT):
+        t = time.perf_counter()
+        out = fn(*args)
+        best = min(best, time.perf_counter() - t)
+    return out, best
+
+print(f"Codecs available: {', '.join(RESPONSE_CODECS)}")
+print(f"{'range':<8} {'variant':<16} {'encode ms':>10} {'raw KB':>10} " + " ".join(f"{c + ' KB':>10} {c + ' ms':>8}" for c in RESPONSE_CODECS))
+
+for label, seconds in RANGES:
+    rows = make_rows(seconds)
+    variants = [
+        ("json (current)", old_encode, (rows, TAGS)),
+        ("orjson legacy", encode_historian, (rows, TAGS, "legacy")),
+        ("orjson columnar", encode_historian, (rows, TAGS, "columnar")),
+    ]
+    for name, fn, args in variants:
+        body, enc_s = timed(fn, *args)
+        line = f"{label:<8} {name:<16} {enc_s * 1000:>10.1f} {len(body) / 1024:>10.0f} "
+        for codec, compress in RESPONSE_CODECS.items():
+            packed, comp_s = timed(compress, body)
+            line += f"{len(packed) / 1024:>10.0f} {comp_s * 1000:>8.1f} "
+        print(line)
+    print()
+
+# Sanity check: legacy orjson output is byte-for-byte equivalent JSON to the old path
+rows = make_rows(60)
+assert json.loads(encode_historian(rows, TAGS)) == json.loads(old_encode(rows, TAGS))
+assert gzip.decompress(RESPONSE_CODECS["gzip"](b"{}" * 600)) == b"{}" * 600
+print("--- Benchmark Complete ---")
@@ -1,23 +1,43 @@
 import os
+import re
+import hashlib
+import ast
+import json
+import graphlib
+import asyncio
 import threading
 import time
 import psycopg2
 from psycopg2 import pool
+from psycopg2.extras import execute_values
 import uvicorn
 import queue
+import gzip
+import heapq
+import orjson
+import psycopg2.errors
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
 from fastapi import FastAPI, Query, Header, HTTPException, Depends, Request
+from fastapi.responses import StreamingResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from opcua import Server
 from pylogix import PLC
 from dotenv import load_dotenv
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from typing import Union, List, Optional
 from datetime import datetime, timezone, timedelta
 from contextlib import asynccontextmanager
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 
+# Optional response codecs: gzip is always available, brotli/zstd when installed
+try: import brotli
+except ImportError: brotli = None
+try: import zstandard
+except ImportError: zstandard = None
+
 # --- SECURITY SETUP ---
 load_dotenv()
 SECRET_KEY = os.getenv("SECRET_KEY", "dev_fallback_key")
@@ -38,6 +58,9 @@ DB_CONFIG = {
     "password": os.getenv("DB_PASSWORD"),
 }
 API_KEY = os.getenv("API_KEY")
+# Local snapshot of the tag configuration, so acquisition can start before the DB answers
+TAG_CACHE_PATH = os.getenv("TAG_CACHE_PATH", "tag_cache.json")
+TAG_CACHE_SCHEMA = 1
 
 WRITEABLE_TAGS = {
     "A25_SIM_Charge", 
@@ -57,8 +80,13 @@ live_data = {"status": "initializing", "tags": {}}
 live_data_lock = threading.Lock()
 tag_map = {}
 opc_tag_nodes = {}
+opc_tag_nodes_lock = threading.Lock()
+opc_tag_folder = None  # (namespace idx, "PLC_Tags" object), set once the OPC-UA server is built
 stop_event = threading.Event()
 historian_queue = queue.Queue(maxsize=100000) 
+alarm_journal_queue = queue.Queue(maxsize=10000)
+startup_metrics = {"tag_config_source": None}
+BOOT_MONOTONIC = time.monotonic()
 
 # --- DB CONNECTION POOL ---
 pg_pool = None
@@ -117,6 +145,22 @@ class Setting(BaseModel):
     key: str
     value: Union[float, str]
 
+class AlarmDefinition(BaseModel):
+    id: int
+    name: str
+    tag: str
+    kind: str  # limit | roc | deviation | state
+    setpoint: float
+    direction: str = "high"  # high | low (ignored for state alarms)
+    ref_tag: Optional[str] = None  # deviation alarms only
+    deadband: float = 0.0
+    delay_s: float = 0.0
+    severity: int = 500
+    is_active: bool = True
+
+class AlarmShelveRequest(BaseModel):
+    minutes: float = Field(60, gt=0, le=7 * 24 * 60)  # at most one week
+
 # --- HELPERS ---
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
@@ -175,6 +219,559 @@ def get_current_active_engineer(current_user: User = Depends(get_current_user)):
 def require_api_key(x_api_key: str = Header(None)):
     if not API_KEY or x_api_key != API_KEY: raise HTTPException(401, "Invalid API Key")
 
+# --- ALARM ENGINE ---
+ALARM_KINDS = ("limit", "roc", "deviation", "state")
+ALARM_EVENT_BUFFER = 1000
+# Event ids are "<boot>-<seq>": seq restarts at 0 with the process, so a client
+# reconnecting with an id from a previous boot must not resume from that seq.
+ALARM_BOOT_ID = format(int(time.time()), "x")
+
+ALARM_SCHEMA_SQL = """
+    CREATE TABLE IF NOT EXISTS app.alarm_definitions (
+        id SERIAL PRIMARY KEY,
+        name TEXT NOT NULL,
+        tag TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        setpoint DOUBLE PRECISION NOT NULL DEFAULT 0,
+        direction TEXT NOT NULL DEFAULT 'high',
+        ref_tag TEXT,
+        deadband DOUBLE PRECISION NOT NULL DEFAULT 0,
+        delay_s DOUBLE PRECISION NOT NULL DEFAULT 0,
+        severity INT NOT NULL DEFAULT 500,
+        is_active BOOLEAN NOT NULL DEFAULT TRUE
+    );
+    CREATE TABLE IF NOT EXISTS app.alarm_journal (
+        id BIGSERIAL PRIMARY KEY,
+        ts TIMESTAMPTZ NOT NULL,
+        alarm_id INT,
+        name TEXT,
+        tag TEXT,
+        event TEXT NOT NULL,
+        value DOUBLE PRECISION,
+        severity INT,
+        username TEXT
+    );
+    CREATE INDEX IF NOT EXISTS alarm_journal_ts_idx ON app.alarm_journal (ts DESC);
+"""
+
+def _num(v):
+    # PLC read errors arrive as "Error: ..." strings; treat them as "no value"
+    if isinstance(v, (int, float)): return float(v)
+    return None
+
+class AlarmEngine:
+    """
+    Evaluates alarm definitions against every PLC poll cycle, server-side.
+
+    Definitions are compiled into parallel column lists (tag, sign, trip and
+    clear thresholds...) so a cycle is a few list comprehensions across ALL
+    alarms; only alarms that should raise or clear, or that have a running
+    on-delay or shelve timer, are visited individually. Transitions go to an in-memory ring buffer (push feed) and
+    to alarm_journal_queue (bulk-written to app.alarm_journal).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.defs = []
+        self.state = {}
+        self.events = deque(maxlen=ALARM_EVENT_BUFFER)
+        self.seq = 0
+        self._prev = {}  # tag -> (value, ts), for rate-of-change
+        self._compile()
+
+    def load(self, defs):
+        with self.lock:
+            self.defs = [d for d in defs if d.is_active and d.kind in ALARM_KINDS]
+            # Keep runtime state of alarms that survive a reload (active/acked/shelved)
+            old = self.state
+            self.state = {d.id: old.get(d.id) or self._blank() for d in self.defs}
+            self._compile()
+        print(f"✅ Alarms: {len(self.defs)} active definitions loaded.")
+
+    @staticmethod
+    def _blank():
+        return {"active": False, "acked": True, "pending_since": None,
+                "shelved_until": None, "raised_ts": None, "value": None}
+
+    def _compile(self):
+        d = self.defs
+        self._kinds = [a.kind for a in d]
+        self._tags = [a.tag for a in d]
+        self._refs = [a.ref_tag for a in d]
+        self._setpoints = [a.setpoint for a in d]
+        # State alarms become "measure = 1.0 when value matches setpoint" with a 0.5 trip
+        self._sign = [1.0 if a.kind == "state" or a.direction != "low" else -1.0 for a in d]
+        # Thresholds are pre-multiplied by sign so "sign * m > trip" covers high and low alarms
+        self._trip = [0.5 if a.kind == "state" else s * a.setpoint for a, s in zip(d, self._sign)]
+        self._clear = [t if a.kind == "state" else t - abs(a.deadband) for a, t in zip(d, self._trip)]
+        self._delay = [max(a.delay_s, 0.0) for a in d]
+        self._roc_tags = {a.tag for a in d if a.kind == "roc"}
+        self._index = {a.id: i for i, a in enumerate(d)}
+        self._active = [self.state[a.id]["active"] for a in d]
+        # Alarms with a running on-delay or shelve timer are checked every cycle
+        self._watch = {i for i, a in enumerate(d)
+                       if self.state[a.id]["pending_since"] or self.state[a.id]["shelved_until"]}
+
+    def _rates(self, tags, ts):
+        rates = {}
+        for t in self._roc_tags:
+            v = _num(tags.get(t))
+            if v is None: continue
+            prev = self._prev.get(t)
+            self._prev[t] = (v, ts)
+            if prev:
+                dt = (ts - prev[1]).total_seconds()
+                if dt > 0: rates[t] = (v - prev[0]) / dt
+        return rates
+
+    def evaluate(self, tags, ts):
+        with self.lock:
+            if not self.defs: return
+            rates = self._rates(tags, ts)
+            vals = [_num(tags.get(t)) for t in self._tags]
+            refs = [_num(tags.get(r)) if r else None for r in self._refs]
+            m = [
+                None if v is None else
+                rates.get(t) if k == "roc" else
+                (abs(v - rv) if rv is not None else None) if k == "deviation" else
+                float(bool(v) == bool(sp)) if k == "state" else
+                v
+                for k, t, v, rv, sp in zip(self._kinds, self._tags, vals, refs, self._setpoints)
+            ]
+            hot = [x is not None and s * x > tr for x, s, tr in zip(m, self._sign, self._trip)]
+            cold = [x is not None and s * x < cl for x, s, cl in zip(m, self._sign, self._clear)]
+            flipped = {i for i, (h, c, act) in enumerate(zip(hot, cold, self._active)) if (c if act else h)}
+
+            for i in sorted(flipped | self._watch):
+                a = self.defs[i]
+                st = self.state[a.id]
+                if st["shelved_until"] and ts >= st["shelved_until"]:
+                    st["shelved_until"] = None
+                    self._emit(a, "unshelved", ts, m[i])
+                if not st["active"]:
+                    if not hot[i]:
+                        st["pending_since"] = None
+                    else:
+                        if st["pending_since"] is None: st["pending_since"] = ts
+                        if (ts - st["pending_since"]).total_seconds() >= self._delay[i]:
+                            st.update(active=True, acked=False, pending_since=None, raised_ts=ts, value=m[i])
+                            self._active[i] = True
+                            self._emit(a, "raised", ts, m[i])
+                elif cold[i]:
+                    st.update(active=False, value=m[i])
+                    self._active[i] = False
+                    self._emit(a, "cleared", ts, m[i])
+                if st["pending_since"] or st["shelved_until"]: self._watch.add(i)
+                else: self._watch.discard(i)
+
+    def _emit(self, a, event, ts, value=None, username=None):
+        self.seq += 1
+        st = self.state.get(a.id, {})
+        ev = {"seq": self.seq, "ts": ts, "alarm_id": a.id, "name": a.name, "tag": a.tag,
+              "event": event, "value": value, "severity": a.severity, "username": username,
+              "shelved": bool(st.get("shelved_until"))}
+        self.events.append(ev)
+        try: alarm_journal_queue.put_nowait(ev)
+        except queue.Full: pass
+
+    def _find(self, alarm_id):
+        return next((a for a in self.defs if a.id == alarm_id), None)
+
+    def ack(self, alarm_id, username):
+        with self.lock:
+            a = self._find(alarm_id)
+            if not a: return False
+            st = self.state[alarm_id]
+            if not st["acked"]:
+                st["acked"] = True
+                self._emit(a, "acked", datetime.now(timezone.utc), st["value"], username)
+            return True
+
+    def shelve(self, alarm_id, minutes, username):
+        with self.lock:
+            a = self._find(alarm_id)
+            if not a: return False
+            now = datetime.now(timezone.utc)
+            self.state[alarm_id]["shelved_until"] = now + timedelta(minutes=minutes)
+            self._watch.add(self._index[alarm_id])
+            self._emit(a, "shelved", now, None, username)
+            return True
+
+    def unshelve(self, alarm_id, username):
+        with self.lock:
+            a = self._find(alarm_id)
+            if not a: return False
+            self.state[alarm_id]["shelved_until"] = None
+            self._emit(a, "unshelved", datetime.now(timezone.utc), None, username)
+            return True
+
+    def summary(self, include_shelved=False):
+        # Standing alarms: still active, or returned to normal but not yet acknowledged
+        with self.lock:
+            out = []
+            for a in self.defs:
+                st = self.state[a.id]
+                if not (st["active"] or not st["acked"]): continue
+                if st["shelved_until"] and not include_shelved: continue
+                out.append({"alarm_id": a.id, "name": a.name, "tag": a.tag, "kind": a.kind,
+                            "severity": a.severity, "active": st["active"], "acked": st["acked"],
+                            "value": st["value"],
+                            "raised_ts": st["raised_ts"].isoformat() if st["raised_ts"] else None,
+                            "shelved_until": st["shelved_until"].isoformat() if st["shelved_until"] else None})
+            return out
+
+    def events_since(self, seq):
+        with self.lock:
+            return [e for e in self.events if e["seq"] > seq]
+
+alarm_engine = AlarmEngine()
+
+def _alarm_event_json(ev):
+    return json.dumps({**ev, "ts": ev["ts"].isoformat()})
+
+def load_alarm_definitions():
+    conn = None
+    try:
+        conn = get_db_conn()
+        with conn.cursor() as cur:
+            cur.execute(ALARM_SCHEMA_SQL)
+            cur.execute("SELECT COUNT(*) FROM app.alarm_definitions")
+            if cur.fetchone()[0] == 0:
+                # Seed with the sensor health bits the UI used to evaluate client-side
+                seed = [(f"{t['name']} fault", t["name"]) for t in TAGS_TO_READ if t["name"].endswith("_Healthy")]
+                if seed:
+                    execute_values(cur, """INSERT INTO app.alarm_definitions (name, tag, kind, setpoint, delay_s)
+                                           VALUES %s""", seed, template="(%s, %s, 'state', 0, 2)")
+            conn.commit()
+            cur.execute("""SELECT id, name, tag, kind, setpoint, direction, ref_tag, deadband, delay_s, severity, is_active
+                           FROM app.alarm_definitions ORDER BY id""")
+            defs = [AlarmDefinition(id=r[0], name=r[1], tag=r[2], kind=r[3], setpoint=r[4], direction=r[5],
+                                    ref_tag=r[6], deadband=r[7], delay_s=r[8], severity=r[9], is_active=r[10])
+                    for r in cur.fetchall()]
+        alarm_engine.load(defs)
+    except Exception as e:
+        print(f"🔴 Alarm Definition Load Failed: {e}")
+        if conn: conn.rollback()
+    finally:
+        release_db_conn(conn)
+
+# --- DERIVED TAGS ---
+DERIVED_SCHEMA_SQL = """
+    CREATE TABLE IF NOT EXISTS app.derived_tags (
+        id SERIAL PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE,
+        expression TEXT NOT NULL,
+        datatype TEXT NOT NULL DEFAULT 'float',
+        is_active BOOLEAN NOT NULL DEFAULT TRUE
+    );
+"""
+
+# Seeded into an empty app.derived_tags; edit/extend in the DB, then POST /api/derived-tags/reload
+DEFAULT_DERIVED_TAGS = [
+    ("A25_Energy_Rate", "rate(A25_Energy_Total) * 3600", "float"),
+    ("A25_Efficiency", "A25_Power / A25_Speed", "float"),
+    ("TT001_Avg60", "avg(TT001.Scaled, 60)", "float"),
+    ("TT002_Avg60", "avg(TT002.Scaled, 60)", "float"),
+    ("TT003_Avg60", "avg(TT003.Scaled, 60)", "float"),
+]
+
+_BIN_OPS = {
+    ast.Add: lambda a, b: a + b,
+    ast.Sub: lambda a, b: a - b,
+    ast.Mult: lambda a, b: a * b,
+    ast.Div: lambda a, b: a / b if b else None,
+    ast.Mod: lambda a, b: a % b if b else None,
+    ast.Pow: lambda a, b: a ** b,
+}
+_CMP_OPS = {
+    ast.Lt: lambda a, b: a < b, ast.LtE: lambda a, b: a <= b,
+    ast.Gt: lambda a, b: a > b, ast.GtE: lambda a, b: a >= b,
+    ast.Eq: lambda a, b: a == b, ast.NotEq: lambda a, b: a != b,
+}
+_PURE_FUNCS = {"abs": abs, "min": min, "max": max, "round": round}
+
+def _dotted_name(node):
+    # PLC member tags like TT001.Scaled parse as Attribute(Name) chains
+    if isinstance(node, ast.Name): return node.id
+    if isinstance(node, ast.Attribute):
+        base = _dotted_name(node.value)
+        return f"{base}.{node.attr}" if base else None
+    return None
+
+def _rate_fn(arg):
+    prev = []
+    def fn(env, ts):
+        v = arg(env, ts)
+        if v is None: return None
+        out = None
+        if prev:
+            dt = (ts - prev[1]).total_seconds()
+            if dt > 0: out = (v - prev[0]) / dt
+            prev.clear()
+        prev.extend((v, ts))
+        return out
+    return fn
+
+def _avg_fn(arg, window_s):
+    buf = deque()
+    total = [0.0]
+    def fn(env, ts):
+        v = arg(env, ts)
+        if v is not None:
+            buf.append((ts, v))
+            total[0] += v
+        cutoff = ts - timedelta(seconds=window_s)
+        while buf and buf[0][0] < cutoff:
+            total[0] -= buf.popleft()[1]
+        return total[0] / len(buf) if buf else None
+    return fn
+
+def compile_expression(expr):
+    """
+    Parses a derived tag expression ONCE into a closure tree.
+    Returns (fn, deps, stateful): fn(env, ts) -> value or None, deps = referenced tag names,
+    stateful = uses rate()/avg() and therefore must run every cycle.
+    Only arithmetic, comparisons, and/or, x if c else y, abs/min/max/round,
+    rate(x) [units per second] and avg(x, window_s) are accepted.
+    """
+    deps = set()
+    stateful = [False]
+
+    def build(node):
+        name = _dotted_name(node)
+        if name is not None:
+            deps.add(name)
+            return lambda env, ts: env.get(name)
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+            c = node.value
+            return lambda env, ts: c
+        if isinstance(node, ast.BinOp) and type(node.op) in _BIN_OPS:
+            op, l, r = _BIN_OPS[type(node.op)], build(node.left), build(node.right)
+            def binop(env, ts):
+                a, b = l(env, ts), r(env, ts)
+                return None if a is None or b is None else op(a, b)
+            return binop
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd, ast.Not)):
+            o, neg = build(node.operand), isinstance(node.op, ast.USub)
+            if isinstance(node.op, ast.Not):
+                return lambda env, ts: None if (v := o(env, ts)) is None else (not v)
+            return lambda env, ts: None if (v := o(env, ts)) is None else (-v if neg else v)
+        if isinstance(node, ast.Compare) and len(node.ops) == 1 and type(node.ops[0]) in _CMP_OPS:
+            op, l, r = _CMP_OPS[type(node.ops[0])], build(node.left), build(node.comparators[0])
+            def cmp(env, ts):
+                a, b = l(env, ts), r(env, ts)
+                return None if a is None or b is None else op(a, b)
+            return cmp
+        if isinstance(node, ast.BoolOp):
+            parts, is_and = [build(v) for v in node.values], isinstance(node.op, ast.And)
+            def boolop(env, ts):
+                vals = [p(env, ts) for p in parts]
+                if any(v is None for v in vals): return None
+                return all(vals) if is_and else any(vals)
+            return boolop
+        if isinstance(node, ast.IfExp):
+            c, a, b = build(node.test), build(node.body), build(node.orelse)
+            def ifexp(env, ts):
+                t = c(env, ts)
+                return None if t is None else (a(env, ts) if t else b(env, ts))
+            return ifexp
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and not node.keywords:
+            fname, args = node.func.id, node.args
+            if fname in _PURE_FUNCS and args:
+                f, parts = _PURE_FUNCS[fname], [build(a) for a in args]
+                def call(env, ts):
+                    vals = [p(env, ts) for p in parts]
+                    return None if any(v is None for v in vals) else f(*vals)
+                return call
+            if fname == "rate" and len(args) == 1:
+                stateful[0] = True
+                return _rate_fn(build(args[0]))
+            if (fname == "avg" and len(args) == 2 and isinstance(args[1], ast.Constant)
+                    and isinstance(args[1].value, (int, float)) and not isinstance(args[1].value, bool)
+                    and args[1].value > 0):
+                stateful[0] = True
+                return _avg_fn(build(args[0]), float(args[1].value))
+        raise ValueError(f"Unsupported expression element: {ast.dump(node)[:60]}")
+
+    fn = build(ast.parse(expr, mode="eval").body)
+    return fn, deps, stateful[0]
+
+class DerivedTagEngine:
+    """
+    Computes calculated tags once per poll cycle on the server.
+
+    Expressions are compiled once at load and ordered by their dependency graph
+    (derived tags may reference other derived tags). Each cycle only the tags
+    whose inputs changed are recomputed; rate()/avg() tags always run since they
+    depend on time as well as on their inputs.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.order = []  # [(name, fn, deps, stateful)] in dependency order
+        self.datatypes = {}
+        self.sources = []  # [name, expression, datatype] rows as loaded, for the tag snapshot
+        self.values = {}
+        self._seen = {}
+        self._inputs = set()
+
+    @property
+    def names(self):
+        return list(self.datatypes)
+
+    def load(self, rows):
+        compiled = {}
+        for name, expr, dtype in rows:
+            try:
+                compiled[name] = (*compile_expression(expr), (dtype or "float").lower())
+            except (SyntaxError, ValueError, TypeError) as e:
+                print(f"⚠️ Derived Tag '{name}' skipped: {e}")
+
+        graph = {n: c[1] & compiled.keys() for n, c in compiled.items()}
+        while True:
+            try:
+                topo = list(graphlib.TopologicalSorter(graph).static_order())
+                break
+            except graphlib.CycleError as e:
+                cycle = set(e.args[1])
+                print(f"⚠️ Derived Tags skipped (circular reference): {sorted(cycle)}")
+                graph = {n: d - cycle for n, d in graph.items() if n not in cycle}
+
+        with self.lock:
+            self.order = [(n, compiled[n][0], compiled[n][1], compiled[n][2]) for n in topo]
+            self.datatypes = {n: compiled[n][3] for n in topo}
+            self.sources = [list(r) for r in rows if r[0] in self.datatypes]
+            self._inputs = set().union(*(d for _, _, d, _ in self.order)) - self.datatypes.keys()
+            self.values = {}
+            self._seen = {}
+        print(f"✅ Derived Tags: {len(self.order)} loaded.")
+
+    def evaluate(self, tags, ts):
+        with self.lock:
+            if not self.order: return {}
+            changed = {t for t in self._inputs if tags.get(t) != self._seen.get(t)}
+            for t in changed: self._seen[t] = tags.get(t)
+
+            env = {**tags, **self.values}
+            for name, fn, deps, stateful in self.order:
+                if not (stateful or name not in self.values or deps & changed): continue
+                # PLC read errors are strings; expressions see them as missing inputs
+                inputs = {k: env.get(k) for k in deps}
+                try: v = fn({k: None if isinstance(x, str) else x for k, x in inputs.items()}, ts)
+                except (ArithmeticError, ValueError, TypeError): v = None
+                if v is not None and self.datatypes[name] in ("bool", "boolean", "bit"): v = bool(v)
+                elif isinstance(v, bool): v = float(v)
+                if v != self.values.get(name, ...): changed.add(name)
+                self.values[name] = v
+                env[name] = v
+            return dict(self.values)
+
+derived_engine = DerivedTagEngine()
+
+def load_derived_tags():
+    global tag_map, TAGS_TO_READ
+    conn = None
+    try:
+        conn = get_db_conn()
+        with conn.cursor() as cur:
+            cur.execute(DERIVED_SCHEMA_SQL)
+            cur.execute("SELECT COUNT(*) FROM app.derived_tags")
+            if cur.fetchone()[0] == 0:
+                execute_values(cur, "INSERT INTO app.derived_tags (name, expression, datatype) VALUES %s", DEFAULT_DERIVED_TAGS)
+            cur.execute("SELECT name, expression, datatype FROM app.derived_tags WHERE is_active ORDER BY id")
+            rows = cur.fetchall()
+            # Derived tags need a tag_lookup id to be historized. They are registered
+            # INACTIVE so the PLC poller never tries to read them from the controller.
+            for name, _, dtype in rows:
+                cur.execute("""INSERT INTO historian.tag_lookup (tag, datatype, is_active)
+                               SELECT %s, %s, FALSE
+                               WHERE NOT EXISTS (SELECT 1 FROM historian.tag_lookup WHERE tag = %s)""",
+                            (name, dtype, name))
+            conn.commit()
+            cur.execute("SELECT tag, id FROM historian.tag_lookup WHERE tag = ANY(%s)", ([r[0] for r in rows],))
+            ids = dict(cur.fetchall())
+        derived_engine.load(rows)
+        tag_map = {**tag_map, **ids}
+        TAGS_TO_READ = [t for t in TAGS_TO_READ if t["name"] not in derived_engine.datatypes]
+    except Exception as e:
+        print(f"🔴 Derived Tag Load Failed: {e}")
+        if conn: conn.rollback()
+    finally:
+        release_db_conn(conn)
+
+# --- TAG CONFIG SNAPSHOT ---
+tag_snapshot_version = None
+
+def _snapshot_payload():
+    return {
+        "tags": sorted([name, tid] for name, tid in tag_map.items()),
+        "read": [[t["name"], t["datatype"]] for t in TAGS_TO_READ],
+        "derived": derived_engine.sources,
+        "alarms": [a.model_dump() for a in alarm_engine.defs],
+    }
+
+def save_tag_snapshot():
+    """
+    Persists the reconciled tag configuration (tag ids, active tags, derived tag
+    and alarm definitions) to TAG_CACHE_PATH. Versioned by content hash, so it is
+    only rewritten when the DB configuration actually changed.
+    """
+    global tag_snapshot_version
+    # Never persist the hard-coded fallback list (dummy ids) over a good snapshot
+    if startup_metrics["tag_config_source"] != "db": return
+    payload = _snapshot_payload()
+    version = hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()[:16]
+    if version == tag_snapshot_version: return
+    tmp = f"{TAG_CACHE_PATH}.tmp"
+    try:
+        with open(tmp, "w") as f:
+            json.dump({"schema": TAG_CACHE_SCHEMA, "version": version,
+                       "saved_at": datetime.now(timezone.utc).isoformat(), **payload}, f)
+            # Data must be on disk before the rename, or a power cut can leave an empty file
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, TAG_CACHE_PATH)  # atomic: a crash never leaves a half-written snapshot
+        try:
+            # Persist the rename itself (directory entry); not supported on every platform
+            dfd = os.open(os.path.dirname(os.path.abspath(TAG_CACHE_PATH)), os.O_RDONLY)
+            try: os.fsync(dfd)
+            finally: os.close(dfd)
+        except OSError: pass
+        tag_snapshot_version = version
+        print(f"💾 Tag snapshot {version} saved ({len(payload['read'])} tags).")
+    except OSError as e:
+        print(f"🟡 Tag snapshot not saved: {e}")
+
+def load_tag_snapshot():
+    global tag_map, TAGS_TO_READ, tag_snapshot_version
+    t0 = time.perf_counter()
+    try:
+        with open(TAG_CACHE_PATH) as f: snap = json.load(f)
+        if snap.get("schema") != TAG_CACHE_SCHEMA: raise ValueError(f"schema {snap.get('schema')}")
+        # Parse and validate everything before touching live state, so a bad
+        # snapshot is rejected whole instead of being half applied
+        new_map = {str(name): int(tid) for name, tid in snap["tags"]}
+        new_read = [{"name": str(n), "datatype": str(d)} for n, d in snap["read"]]
+        derived = [(str(n), str(e), str(d)) for n, e, d in snap["derived"]]
+        alarms = [AlarmDefinition(**a) for a in snap["alarms"]]
+        version = str(snap["version"])
+        saved_at = str(snap.get("saved_at", "unknown time"))
+    except FileNotFoundError:
+        print(f"🟡 No tag snapshot at {TAG_CACHE_PATH}; waiting for DB tag sync.")
+        return False
+    except Exception as e:
+        print(f"🟡 Tag snapshot unusable ({e}); waiting for DB tag sync.")
+        return False
+
+    derived_engine.load(derived)
+    alarm_engine.load(alarms)
+    tag_map, TAGS_TO_READ, tag_snapshot_version = new_map, new_read, version
+    startup_metrics["tag_config_source"] = "snapshot"
+    startup_metrics["snapshot_load_ms"] = round((time.perf_counter() - t0) * 1000, 2)
+    print(f"⚡ Tag snapshot {version} from {saved_at}: {len(TAGS_TO_READ)} tags "
+          f"in {startup_metrics['snapshot_load_ms']} ms.")
+    return True
+
 # --- THREADS ---
 PLC_SOURCE_IP = os.getenv("PLC_SOURCE_IP", None)
 
@@ -234,6 +831,11 @@ def plc_polling_task():
                 timestamp = datetime.now(timezone.utc)
                 # ... (live data processing and historian_queue write unchanged) ...
                 
+                if "time_to_first_sample_s" not in startup_metrics:
+                    startup_metrics["time_to_first_sample_s"] = round(time.monotonic() - BOOT_MONOTONIC, 3)
+                    print(f"⏱️ Time to first sample: {startup_metrics['time_to_first_sample_s']} s "
+                          f"(tag config from {startup_metrics['tag_config_source']}).")
+
                 with live_data_lock:
                     live_data["status"] = "connected"
                     temp_tags = {}
@@ -250,8 +852,20 @@ def plc_polling_task():
                                 historian_queue.put_nowait({"tag": tagname, "value": val, "ts": timestamp})
                             except queue.Full: pass
 
+                    try:
+                        for name, val in derived_engine.evaluate(temp_tags, timestamp).items():
+                            temp_tags[name] = val
+                            if isinstance(val, (int, float, bool)):
+                                try: historian_queue.put_nowait({"tag": name, "value": val, "ts": timestamp})
+                                except queue.Full: pass
+                    except Exception as e: print(f"🔴 Derived Tag Evaluation Error: {e}")
+
                     live_data["tags"] = temp_tags
 
+                # Alarm faults must never be mistaken for PLC faults (which force a reconnect)
+                try: alarm_engine.evaluate(temp_tags, timestamp)
+                except Exception as e: print(f"🔴 Alarm Evaluation Error: {e}")
+
                 time.sleep(1)
                 
             except Exception as e:
@@ -276,7 +890,7 @@ def opcua_updater_task():
     while not stop_event.is_set():
         with live_data_lock: snap = live_data.get("tags", {}).copy()
         for k,v in snap.items():
-            if k in opc_tag_nodes and not isinstance(v, str):
+            if k in opc_tag_nodes and v is not None and not isinstance(v, str):
                 try: opc_tag_nodes[k].set_value(v)
                 except: pass
         time.sleep(0.5)
@@ -288,7 +902,8 @@ def historian_ingester_task():
     
     while not stop_event.is_set():
         time.sleep(2)
-        if historian_queue.empty() or not tag_map: continue
+        # Until the DB pool exists, samples stay spooled in historian_queue instead of being dropped
+        if not pg_pool or historian_queue.empty() or not tag_map: continue
         
         batch = []
         while not historian_queue.empty() and len(batch) < 500:
@@ -299,6 +914,7 @@ def historian_ingester_task():
         count = 0
         # Map Tag Name -> Datatype string
         name_map = {t["name"]: t["datatype"].lower() for t in TAGS_TO_READ}
+        name_map.update(derived_engine.datatypes)
         
         try:
             conn = get_db_conn()
@@ -358,7 +974,33 @@ def historian_ingester_task():
         finally:
             release_db_conn(conn)
 
+def alarm_journal_task():
+    print("🚀 Alarm Journal Writer started.")
+    while not stop_event.is_set():
+        time.sleep(2)
+        if not pg_pool or alarm_journal_queue.empty(): continue
+
+        batch = []
+        while not alarm_journal_queue.empty() and len(batch) < 1000:
+            batch.append(alarm_journal_queue.get())
+
+        conn = None
+        try:
+            conn = get_db_conn()
+            with conn.cursor() as cur:
+                execute_values(cur, """INSERT INTO app.alarm_journal (ts, alarm_id, name, tag, event, value, severity, username)
+                                       VALUES %s""",
+                               [(e["ts"], e["alarm_id"], e["name"], e["tag"], e["event"], e["value"], e["severity"], e["username"])
+                                for e in batch])
+            conn.commit()
+        except Exception as e:
+            print(f"🔴 Alarm Journal Write Error ({len(batch)} events dropped): {e}")
+            if conn: conn.rollback()
+        finally:
+            release_db_conn(conn)
+
 def sync_tags_with_db():
+    """Returns True when the tag configuration came from the DB."""
     global tag_map, TAGS_TO_READ
     print("🔵 Syncing tags...")
     conn = None
@@ -409,12 +1051,19 @@ def sync_tags_with_db():
         with conn.cursor() as cur:
             cur.execute("SELECT id, tag, datatype, is_active FROM historian.tag_lookup")
             rows = cur.fetchall()
-            tag_map = {row[1]: row[0] for row in rows}
-            TAGS_TO_READ = [{"name": row[1], "datatype": row[2]} for row in rows if row[3]]
-            print(f"✅ Active Tags: {len(TAGS_TO_READ)} from DB")
+            # Derived tags are computed server-side, never read from the PLC
+            active = [{"name": row[1], "datatype": row[2]} for row in rows if row[3] and row[1] not in derived_engine.datatypes]
+            print(f"✅ Active Tags: {len(active)} from DB")
+            if active:
+                tag_map = {row[1]: row[0] for row in rows}
+                TAGS_TO_READ = active
+                return True
             
             # CRITICAL FIX: IF NO TAGS CAME FROM DB, FORCE THE NEW LIST
-            if not TAGS_TO_READ:
+            if startup_metrics["tag_config_source"] is not None:
+                # A snapshot or earlier sync already gave us real ids; never trade them for dummies
+                print(f"⚠️ DB returned no active tags. Keeping current tag config ({startup_metrics['tag_config_source']}).")
+            else:
                 print("⚠️ DB tag sync failed or returned no active tags. Forcing use of new hardcoded list.")
                 # We are forcing the PLC poller to read these names, but they won't be saved to DB historian
                 TAGS_TO_READ = [t for t in NEW_TAG_LIST] 
@@ -422,14 +1071,34 @@ def sync_tags_with_db():
                 # NOTE: This only works if you manually update the DB's tag_lookup with these tags and IDs later
                 # For now, we only care that the PLC Poller reads the names
                 tag_map = {t['name']: 9999 for t in TAGS_TO_READ} # Use a dummy ID for now
+                startup_metrics["tag_config_source"] = "fallback"
 
     except Exception as e:
-        print(f"🔴 Tag Sync Failed: {e}. Forcing use of new hardcoded list.")
-        TAGS_TO_READ = [t for t in NEW_TAG_LIST] 
-        tag_map = {t['name']: 9999 for t in TAGS_TO_READ}
+        if startup_metrics["tag_config_source"] is not None:
+            # Snapshot / earlier sync ids are real tag_lookup ids, far better than the dummy fallback
+            print(f"🔴 Tag Sync Failed: {e}. Keeping current tag config ({startup_metrics['tag_config_source']}).")
+        else:
+            print(f"🔴 Tag Sync Failed: {e}. Forcing use of new hardcoded list.")
+            TAGS_TO_READ = [t for t in NEW_TAG_LIST] 
+            tag_map = {t['name']: 9999 for t in TAGS_TO_READ}
+            startup_metrics["tag_config_source"] = "fallback"
     finally:
         release_db_conn(conn)
         print(f"✅ Poller will attempt to read {len(TAGS_TO_READ)} tags.")
+    return False
+
+def ensure_opc_nodes():
+    # Adds nodes for any tag (PLC tags + derived tags) that does not have one yet
+    if not opc_tag_folder: return
+    idx, pf = opc_tag_folder
+    with opc_tag_nodes_lock:
+        for name in [t["name"] for t in TAGS_TO_READ] + derived_engine.names:
+            if name in opc_tag_nodes: continue
+            try:
+                n = pf.add_variable(idx, name, 0)
+                n.set_writable()
+                opc_tag_nodes[name] = n
+            except: pass
 
 # --- LIFESPAN ---
 @asynccontextmanager
@@ -445,6 +1114,10 @@ async def lifespan(app: FastAPI):
     
     db_thread = threading.Thread(target=init_db_pool, daemon=True)
     db_thread.start()
+
+    # Fast path: the last reconciled tag configuration is on local disk, so polling,
+    # OPC-UA nodes and (spooled) historian capture start now instead of after the DB answers.
+    load_tag_snapshot()
     
     # 2. OPC UA Setup
     s = Server()
@@ -453,13 +1126,16 @@ async def lifespan(app: FastAPI):
     idx = s.register_namespace("Flywheel")
     obj = s.get_objects_node()
     pf = obj.add_object(idx, "PLC_Tags")
-    # Note: opc_tag_nodes will be populated once DB connects and Sync runs
+    global opc_tag_folder
+    opc_tag_folder = (idx, pf)
+    ensure_opc_nodes()
     
     ts = [
         threading.Thread(target=plc_polling_task, daemon=True),
         threading.Thread(target=s.start, daemon=True),
         threading.Thread(target=opcua_updater_task, daemon=True),
-        threading.Thread(target=historian_ingester_task, daemon=True)
+        threading.Thread(target=historian_ingester_task, daemon=True),
+        threading.Thread(target=alarm_journal_task, daemon=True)
     ]
     for t in ts: t.start()
     
@@ -468,18 +1144,23 @@ async def lifespan(app: FastAPI):
     # let's add a "Maintenance Thread" that syncs tags once DB is up)
     def maintenance_task():
         tags_loaded = False
+        engines_loaded = startup_metrics["tag_config_source"] == "snapshot"
         while not stop_event.is_set():
             if pg_pool and not tags_loaded:
-                sync_tags_with_db()
-                # Create nodes now that we have tags
-                global opc_tag_nodes
-                for t in TAGS_TO_READ:
-                    try:
-                        n = pf.add_variable(idx, t["name"], 0)
-                        n.set_writable()
-                        opc_tag_nodes[t["name"]] = n
-                    except: pass
-                tags_loaded = True
+                # Reconcile whatever we booted with (snapshot or nothing) against the DB
+                tags_loaded = sync_tags_with_db()
+                # Reloading resets rate()/avg() state, so failed retries keep the engines as they are
+                if tags_loaded or not engines_loaded:
+                    load_derived_tags()
+                    load_alarm_definitions()
+                    engines_loaded = True
+                ensure_opc_nodes()
+                if tags_loaded:
+                    startup_metrics["tag_config_source"] = "db"
+                    save_tag_snapshot()
+                    startup_metrics["db_reconciled_s"] = round(time.monotonic() - BOOT_MONOTONIC, 3)
+                else:
+                    time.sleep(30)  # keep the fallback configuration, retry the sync later
             time.sleep(1)
             
     threading.Thread(target=maintenance_task, daemon=True).start()
@@ -508,7 +1189,7 @@ async def log_requests(request: Request, call_next):
 
 # --- ENDPOINTS ---
 @app.get("/")
-def health_check(): return {"status": "online", "ts": datetime.now().isoformat()}
+def health_check(): return {"status": "online", "ts": datetime.now().isoformat(), "startup": startup_metrics}
 
 @app.post("/token", response_model=Token)
 def login(form_data: OAuth2PasswordRequestForm = Depends()):
@@ -545,94 +1226,402 @@ def update_tag(tag_id: int, u: TagUpdate, user: User = Depends(get_current_activ
             res = cur.fetchone()
             conn.commit()
             if res:
-                sync_tags_with_db()
+                if sync_tags_with_db(): save_tag_snapshot()
+                ensure_opc_nodes()  # a newly activated tag needs its node
                 return Tag(id=res[0], tag=res[1], datatype=res[2], is_active=res[3])
             raise HTTPException(404, "Tag not found")
     finally:
         release_db_conn(conn)
 
+# --- HISTORIAN RESPONSE ENCODING ---
+COMPRESS_MIN_BYTES = 1024
+HISTORIAN_CACHE_MAX_BYTES = 64 * 1024 * 1024
+HISTORIAN_CACHE_TTL_S = 300
+historian_cache = OrderedDict()  # key -> (created_monotonic, {encoding: body})
+historian_cache_lock = threading.Lock()
+historian_cache_bytes = 0
+
+def _codecs():
+    codecs = {}
+    if zstandard: codecs["zstd"] = lambda b: zstandard.ZstdCompressor(level=3).compress(b)
+    if brotli: codecs["br"] = lambda b: brotli.compress(b, quality=5)
+    codecs["gzip"] = lambda b: gzip.compress(b, compresslevel=6)
+    return codecs
+
+RESPONSE_CODECS = _codecs()  # in server preference order
+
+def negotiate_encoding(accept_encoding: Optional[str]):
+    if not accept_encoding: return "identity"
+    offered, refused = set(), set()
+    for part in accept_encoding.split(","):
+        name, *params = [p.strip() for p in part.split(";")]
+        q = 1.0
+        for p in params:
+            key, _, val = p.partition("=")
+            if key.strip().lower() == "q":
+                try: q = float(val)
+                except ValueError: q = 0.0
+        (offered if q > 0 else refused).add(name.lower())
+    # "*" only stands in for codings the client did not explicitly refuse
+    wildcard = "*" in offered
+    return next((c for c in RESPONSE_CODECS
+                 if c in offered or (wildcard and c not in refused)), "identity")
+
+def compress_body(body: bytes, encoding: str):
+    # Returns (body, encoding actually applied); tiny payloads are not worth compressing
+    if encoding == "identity" or len(body) < COMPRESS_MIN_BYTES: return body, "identity"
+    return RESPONSE_CODECS[encoding](body), encoding
+
+def encode_historian(rows, tags, fmt="legacy") -> bytes:
+    """
+    rows: (ts, tag, value) ordered by ts.
+    legacy:   {tag: [{"ts": iso, "value": v}, ...]}           (what the UI consumes today)
+    columnar: {"tags": {tag: {"t": [epoch_ms, ...], "v": [...]}}} (~3-4x smaller, no per-row dicts)
+    """
+    if fmt == "columnar":
+        cols = {t: ([], []) for t in tags}
+        for ts, tag, v in rows:
+            if v is None: continue
+            c = cols[tag]
+            c[0].append(int(ts.timestamp() * 1000))
+            c[1].append(v)
+        return orjson.dumps({"tags": {t: {"t": c[0], "v": c[1]} for t, c in cols.items()}})
+    # orjson serializes datetimes natively, in the same format as isoformat()
+    res = {t: [] for t in tags}
+    for ts, tag, v in rows:
+        if v is not None: res[tag].append({"ts": ts, "value": v})
+    return orjson.dumps(res)
+
+def _evict_historian(key):
+    # Caller holds historian_cache_lock
+    global historian_cache_bytes
+    _, bodies = historian_cache.pop(key)
+    historian_cache_bytes -= sum(len(b) for b, _ in bodies.values())
+
+def _cached_historian(key, encoding):
+    with historian_cache_lock:
+        hit = historian_cache.get(key)
+        if not hit: return None
+        if time.monotonic() - hit[0] > HISTORIAN_CACHE_TTL_S:
+            _evict_historian(key)
+            return None
+        historian_cache.move_to_end(key)
+        return hit[1].get(encoding)
+
+def _store_historian(key, encoding, entry):
+    global historian_cache_bytes
+    with historian_cache_lock:
+        hit = historian_cache.get(key)
+        if hit and time.monotonic() - hit[0] > HISTORIAN_CACHE_TTL_S:
+            _evict_historian(key)
+            hit = None
+        created, bodies = hit or (time.monotonic(), {})
+        if encoding in bodies: return
+        bodies[encoding] = entry  # (body, applied encoding)
+        historian_cache[key] = (created, bodies)
+        historian_cache.move_to_end(key)
+        historian_cache_bytes += len(entry[0])
+        while historian_cache_bytes > HISTORIAN_CACHE_MAX_BYTES and historian_cache:
+            _evict_historian(next(iter(historian_cache)))
+
+def historian_response(body: bytes, encoding: str):
+    headers = {"Vary": "Accept-Encoding"}
+    if encoding != "identity": headers["Content-Encoding"] = encoding
+    return Response(content=body, media_type="application/json", headers=headers)
+
+def parse_time_range(start_time: Optional[str], end_time: Optional[str]):
+    st = start_time or "1970-01-01T00:00:00Z"
+    et = end_time or datetime.now(timezone.utc).isoformat()
+    try:
+        # Naive timestamps are taken as UTC so they compare with tz-aware ones
+        st_obj, et_obj = (datetime.fromisoformat(x.replace('Z', '+00:00')) for x in (st, et))
+        return tuple(x if x.tzinfo else x.replace(tzinfo=timezone.utc) for x in (st_obj, et_obj))
+    except ValueError:
+        return datetime(1970, 1, 1, tzinfo=timezone.utc), datetime.now(timezone.utc)
+
+# --- HISTORIAN QUERY PLANNER ---
+FANOUT_MIN_TAGS = 4  # fewer pens: one statement beats the fan-out overhead
+FANOUT_MIN_RANGE_S = 6 * 3600  # live chart polls (seconds-long windows) always run as one statement
+FANOUT_MIN_CHUNK_S = 86400  # never split the time range into chunks shorter than a day
+FANOUT_MAX_WORKERS = 8  # shared by all requests, well under the pool's maxconn=20
+HISTORIAN_DEADLINE_S = 25  # below the UI's 30 s axios timeout
+historian_executor = ThreadPoolExecutor(max_workers=FANOUT_MAX_WORKERS, thread_name_prefix="historian")
+
+# Buckets with a fixed width; time chunks are aligned to these so no bucket straddles two chunks.
+# Week/month buckets have their own origins, so those ranges are only split per tag.
+FIXED_BUCKET_SECONDS = {"5 minutes": 300, "1 hour": 3600, "6 hours": 21600}
+
+def historian_bucket(dur):
+    # RAW/AGGREGATION SWITCH (1800 seconds = 30 minutes); None means raw rows
+    if dur <= 1800: return None
+    # Aggressive Hierarchical Time Buckets
+    if dur > 86400 * 365 * 2: # > 2 years (This should catch the 'All Time' span)
+        return "1 month" 
+    elif dur > 86400 * 30: # > 1 month
+        return "1 week" 
+    elif dur > 86400 * 7: # > 1 week
+        return "6 hours" # 7 days * 4 per day = 28 points. Very fast.
+    elif dur > 86400 * 2: # > 2 days
+        return "1 hour" # 2 days * 24 per day = 48 points. Fast.
+    return "5 minutes" # Default for > 30 minutes up to 2 days. 
+
+def _historian_sql(buck, inclusive_end):
+    end_op = "<=" if inclusive_end else "<"
+    if buck is None:
+        return f"""SELECT h.ts, tl.tag, COALESCE(h.value_float, h.value_int::double precision, h.value_bool::int::double precision) 
+                 FROM historian.historian h JOIN historian.tag_lookup tl ON h.tag_id = tl.id 
+                 WHERE tl.tag = ANY(%s) AND h.ts >= %s AND h.ts {end_op} %s ORDER BY h.ts ASC"""
+    return f"""
+        SELECT 
+            time_bucket(%s, h.ts) as b, 
+            tl.tag, 
+            -- FIX: CHANGE AVG() to MAX() for more robust aggregation over long periods
+            MAX( 
+                CASE
+                    WHEN h.value_float IS NOT NULL THEN h.value_float
+                    WHEN h.value_int IS NOT NULL THEN h.value_int::double precision
+                    WHEN h.value_bool IS NOT NULL THEN h.value_bool::int::double precision
+                    ELSE NULL
+                END
+            )
+        FROM historian.historian h 
+        JOIN historian.tag_lookup tl ON h.tag_id = tl.id
+        WHERE tl.tag = ANY(%s) 
+          AND h.ts >= %s 
+          AND h.ts {end_op} %s 
+        GROUP BY b, tl.tag 
+        ORDER BY b ASC
+    """
+
+def plan_historian_query(tags, st, et, buck):
+    """
+    Splits a long-range historian request (>= FANOUT_MIN_RANGE_S, so always a
+    bucketed one; raw queries cover at most 30 min) into independent subqueries:
+    one per tag once there are FANOUT_MIN_TAGS or more, and, for the fixed-width
+    buckets in FIXED_BUCKET_SECONDS, into bucket-aligned time chunks until
+    FANOUT_MAX_WORKERS subqueries exist. Shorter ranges stay a single statement.
+    Returns [(tags, lo, hi, inclusive_end)]; chunks are [lo, hi) except the last.
+    """
+    if (et - st).total_seconds() < FANOUT_MIN_RANGE_S: return [(list(tags), st, et, True)]
+    groups = [[t] for t in tags] if len(tags) >= FANOUT_MIN_TAGS else [list(tags)]
+    step = FIXED_BUCKET_SECONDS.get(buck, 0)
+    n_chunks = 1
+    if step and len(groups) < FANOUT_MAX_WORKERS:
+        n_chunks = max(1, min(FANOUT_MAX_WORKERS // len(groups), int((et - st).total_seconds() // FANOUT_MIN_CHUNK_S)))
+
+    edges = [st]
+    width = (et - st).total_seconds() / n_chunks
+    for i in range(1, n_chunks):
+        edge = datetime.fromtimestamp((st.timestamp() + i * width) // step * step, timezone.utc)
+        if edges[-1] < edge < et: edges.append(edge)
+    edges.append(et)
+    spans = list(zip(edges, edges[1:]))
+    return [(g, lo, hi, i == len(spans) - 1) for g in groups for i, (lo, hi) in enumerate(spans)]
+
+def _run_historian_part(part, buck, deadline):
+    tags, lo, hi, inclusive_end = part
+    sql = _historian_sql(buck, inclusive_end)
+    params = (tags, lo, hi) if buck is None else (buck, tags, lo, hi)
+    remaining_ms = int((deadline - time.monotonic()) * 1000)
+    if remaining_ms <= 0: raise TimeoutError()
+    conn = None
+    try:
+        conn = get_db_conn()
+        with conn.cursor() as cur:
+            # Let the DB abandon work the client will never see
+            cur.execute("SET LOCAL statement_timeout = %s", (remaining_ms,))
+            cur.execute(sql, params)
+            return cur.fetchall()
+    except psycopg2.errors.QueryCanceled:
+        raise TimeoutError()
+    finally:
+        if conn:
+            # Ends the read transaction so SET LOCAL does not leak to the next pool user
+            try: conn.rollback()
+            except Exception: pass
+        release_db_conn(conn)
+
+def fetch_historian_rows(tags, st, et, buck, fanout=True, deadline_s=HISTORIAN_DEADLINE_S):
+    """
+    Runs the planned subqueries concurrently on historian_executor and k-way
+    merges their (already ts-ordered) results back into one ts-ordered list,
+    the same rows the single statement would have returned.
+    Raises TimeoutError when the overall deadline passes.
+    """
+    deadline = time.monotonic() + deadline_s
+    plan = plan_historian_query(tags, st, et, buck) if fanout else [(list(tags), st, et, True)]
+    print(f"🔎 Historian: {len(tags)} tags, {st.isoformat()} -> {et.isoformat()}, "
+          f"bucket={buck or 'raw'}, {len(plan)} subquer{'y' if len(plan) == 1 else 'ies'}")
+    if len(plan) == 1:
+        return _run_historian_part(plan[0], buck, deadline)
+
+    futures = [historian_executor.submit(_run_historian_part, p, buck, deadline) for p in plan]
+    done, pending = wait(futures, timeout=max(deadline - time.monotonic(), 0))
+    if pending:
+        for f in pending: f.cancel()
+        raise TimeoutError()
+    return list(heapq.merge(*(f.result() for f in futures), key=lambda r: r[0]))
+
 @app.get("/api/historian")
-def get_historian(tags: List[str] = Query(None), start_time: Optional[str] = None, end_time: Optional[str] = None):
+def get_historian(tags: List[str] = Query(None), start_time: Optional[str] = None, end_time: Optional[str] = None,
+                  format: str = Query("legacy", pattern="^(legacy|columnar)$"),
+                  accept_encoding: Optional[str] = Header(None)):
     
     if not tags: return {}
-    st = start_time or "1970-01-01T00:00:00Z"
-    et = end_time or datetime.utcnow().isoformat()
-    
-    dur = 9999999
+    st_obj, et_obj = parse_time_range(start_time, end_time)
+    dur = (et_obj - st_obj).total_seconds()
+    encoding = negotiate_encoding(accept_encoding)
+
+    # Ranges that ended a while ago no longer change: serve them from the
+    # precomputed (already encoded + compressed) cache.
+    cache_key = None
+    if et_obj < datetime.now(timezone.utc) - timedelta(minutes=5):
+        cache_key = (tuple(tags), st_obj, et_obj, format)
+        hit = _cached_historian(cache_key, encoding)
+        if hit is not None: return historian_response(*hit)
+
     try:
-        st_obj = datetime.fromisoformat(st.replace('Z', '+00:00'))
-        et_obj = datetime.fromisoformat(et.replace('Z', '+00:00'))
-        dur = (et_obj - st_obj).total_seconds()
-    except:
-        st_obj = datetime(1970, 1, 1, tzinfo=timezone.utc)
-        et_obj = datetime.now(timezone.utc)
-
-    # RAW/AGGREGATION SWITCH (1800 seconds = 30 minutes)
-    raw = dur <= 1800 
+        rows = fetch_historian_rows(tags, st_obj, et_obj, historian_bucket(dur))
+    except TimeoutError:
+        raise HTTPException(504, f"Historian query exceeded {HISTORIAN_DEADLINE_S}s deadline")
+    except Exception as e:
+        print(f"🔴 Query Error: {e}")
+        return {"error": str(e)}
+
+    entry = compress_body(encode_historian(rows, tags, format), encoding)
+    if cache_key: _store_historian(cache_key, encoding, entry)
+    return historian_response(*entry)
+
+HISTORIAN_STATS_SQL = """
+    WITH samples AS (
+        SELECT tl.tag, h.tag_id, h.ts,
+               COALESCE(h.value_float, h.value_int::double precision, h.value_bool::int::double precision) AS v,
+               h.value_bool AS b, FALSE AS is_prior
+        FROM historian.historian h JOIN historian.tag_lookup tl ON h.tag_id = tl.id
+        WHERE tl.tag = ANY(%(tags)s) AND h.ts >= %(st)s AND h.ts <= %(et)s
+          AND COALESCE(h.value_float, h.value_int::double precision, h.value_bool::int::double precision) IS NOT NULL
+        UNION ALL
+        -- Last sample before the range: its value holds from start_time until the first
+        -- in-range sample. Anything older than max_gap would be a gap anyway.
+        SELECT tl.tag, tl.id, p.ts, p.v, p.b, TRUE
+        FROM historian.tag_lookup tl
+        CROSS JOIN LATERAL (
+            SELECT h.ts,
+                   COALESCE(h.value_float, h.value_int::double precision, h.value_bool::int::double precision) AS v,
+                   h.value_bool AS b
+            FROM historian.historian h
+            WHERE h.tag_id = tl.id AND h.ts < %(st)s AND h.ts >= %(st)s - %(gap)s
+              AND COALESCE(h.value_float, h.value_int::double precision, h.value_bool::int::double precision) IS NOT NULL
+            ORDER BY h.ts DESC LIMIT 1
+        ) p
+        WHERE tl.tag = ANY(%(tags)s)
+    ), s AS (
+        SELECT tag, ts, v, b, is_prior,
+               LEAST(COALESCE(LEAD(ts) OVER (PARTITION BY tag_id ORDER BY ts), %(et)s), %(et)s) AS next_ts
+        FROM samples
+    ), d AS (
+        -- Sample-and-hold: each sample lasts until the next one, unless that is a gap
+        SELECT tag, ts, v, b, is_prior, next_ts - ts > %(gap)s AS is_gap,
+               GREATEST(ts, %(st)s) AS hold_start,
+               CASE WHEN next_ts - ts > %(gap)s THEN GREATEST(ts, %(st)s) ELSE next_ts END AS hold_end
+        FROM s
+    ), p AS (
+        {pieces}
+    )
+    SELECT tag, bkt,
+           COUNT(*) FILTER (WHERE counted),
+           MIN(v) FILTER (WHERE counted), MAX(v) FILTER (WHERE counted),
+           AVG(v) FILTER (WHERE counted), STDDEV_SAMP(v) FILTER (WHERE counted),
+           SUM(v * dur) / NULLIF(SUM(dur), 0),
+           SUM(v * dur),
+           SUM(dur),
+           COUNT(*) FILTER (WHERE counted AND is_gap),
+           BOOL_OR(b IS NOT NULL),
+           COALESCE(SUM(dur) FILTER (WHERE b), 0),
+           MIN(ts) FILTER (WHERE counted), MAX(ts) FILTER (WHERE counted)
+    FROM p
+    GROUP BY {grouping}
+    ORDER BY tag, bkt NULLS FIRST
+"""
+
+# One piece per sample: the whole hold, counted once unless it is the carried-in prior sample
+STATS_PIECES_TOTAL = """
+        SELECT d.*, NULL::timestamptz AS bkt, NOT is_prior AS counted,
+               EXTRACT(EPOCH FROM (hold_end - hold_start))::double precision AS dur
+        FROM d
+"""
+
+# Holds are split at bucket edges so each bucket only gets the time that falls inside it;
+# the sample itself (count/min/max/...) is counted in the bucket it was taken in.
+STATS_PIECES_BUCKETED = """
+        SELECT d.*, bk AS bkt,
+               NOT is_prior AND bk = time_bucket(%(bucket)s::interval, ts) AS counted,
+               EXTRACT(EPOCH FROM (LEAST(hold_end, bk + %(bucket)s::interval) - GREATEST(hold_start, bk)))::double precision AS dur
+        FROM d
+        CROSS JOIN LATERAL generate_series(time_bucket(%(bucket)s::interval, hold_start),
+                                           GREATEST(hold_end - interval '1 microsecond', hold_start),
+                                           %(bucket)s::interval) AS bk
+"""
+
+STATS_BUCKET_RE = re.compile(r"^([1-9]\d*) ?(second|minute|hour|day|week|month)s?$")
+STATS_UNIT_SECONDS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400, "week": 604800, "month": 2592000}
+STATS_MAX_BUCKETS = 10000  # per tag; every bucket is a result row
+STATS_MAX_GAP_S = 7 * 86400
+
+def _stats_row(r):
+    is_bool = bool(r[11])
+    return {
+        "count": r[2], "min": r[3], "max": r[4], "mean": r[5], "stddev": r[6],
+        "twa": r[7],  # time-weighted average
+        "integral": r[8],  # value * seconds (e.g. kW -> kJ); integral_h is value * hours (kW -> kWh)
+        "integral_h": r[8] / 3600 if r[8] is not None else None,
+        "covered_s": r[9], "gaps": r[10],
+        "time_true_s": r[12] if is_bool else None,
+        # None when only the carried-in prior value covers this range/bucket
+        "first_ts": r[13].isoformat() if r[13] else None, "last_ts": r[14].isoformat() if r[14] else None,
+    }
+
+@app.get("/api/historian/stats")
+def get_historian_stats(tags: List[str] = Query(None), start_time: Optional[str] = None, end_time: Optional[str] = None,
+                        bucket: Optional[str] = None, max_gap_s: float = Query(60, gt=0, le=STATS_MAX_GAP_S)):
+    """
+    Per-tag statistics over a range, computed in ONE database pass for all tags.
+    Time-weighted values treat each sample as held until the next one; holds
+    longer than max_gap_s count as gaps (no coverage, no contribution). The last
+    sample before start_time (within max_gap_s) covers the start of the range.
+    With bucket (e.g. "1 hour") a per-bucket breakdown is returned alongside the
+    totals; holds are clipped at bucket edges, while count/min/max/mean/stddev
+    use the samples taken inside each bucket.
+    """
+    if not tags: return {}
+    st_obj, et_obj = parse_time_range(start_time, end_time)
+    if bucket:
+        m = STATS_BUCKET_RE.match(bucket.strip())
+        if not m: raise HTTPException(400, "bucket must look like '15 minutes', '1 hour', '1 day'")
+        width_s = int(m.group(1)) * STATS_UNIT_SECONDS[m.group(2)]
+        if (et_obj - st_obj).total_seconds() / width_s > STATS_MAX_BUCKETS:
+            raise HTTPException(400, f"bucket too small for this range (max {STATS_MAX_BUCKETS} buckets)")
+
+    if bucket:
+        sql = HISTORIAN_STATS_SQL.format(pieces=STATS_PIECES_BUCKETED, grouping="GROUPING SETS ((tag), (tag, bkt))")
+    else:
+        sql = HISTORIAN_STATS_SQL.format(pieces=STATS_PIECES_TOTAL, grouping="tag, bkt")
+    params = {"tags": tags, "st": st_obj, "et": et_obj, "gap": timedelta(seconds=max_gap_s), "bucket": bucket}
+
     conn = None
-    
     try:
         conn = get_db_conn()
         with conn.cursor() as cur:
-            if raw:
-                # RAW QUERY block (unchanged)
-                sql = """SELECT h.ts, tl.tag, COALESCE(h.value_float, h.value_int::double precision, h.value_bool::int::double precision) 
-                         FROM historian.historian h JOIN historian.tag_lookup tl ON h.tag_id = tl.id 
-                         WHERE tl.tag = ANY(%s) AND h.ts >= %s AND h.ts <= %s ORDER BY h.ts ASC"""
-                params = (tags, st_obj, et_obj)
-            else:
-                # AGGREGATED QUERY block - FIX: Aggressive Hierarchical Time Buckets
-                
-                # Check for All Time (2 years in the frontend logic) and huge queries first
-                if dur > 86400 * 365 * 2: # > 2 years (This should catch the 'All Time' span)
-                    buck = "1 month" 
-                elif dur > 86400 * 30: # > 1 month
-                    buck = "1 week" 
-                elif dur > 86400 * 7: # > 1 week
-                    buck = "6 hours" # 7 days * 4 per day = 28 points. Very fast.
-                elif dur > 86400 * 2: # > 2 days
-                    buck = "1 hour" # 2 days * 24 per day = 48 points. Fast.
-                else:
-                    buck = "5 minutes" # Default for > 30 minutes up to 2 days. 
-                
-                sql = """
-                    SELECT 
-                        time_bucket(%s, h.ts) as b, 
-                        tl.tag, 
-                        -- FIX: CHANGE AVG() to MAX() for more robust aggregation over long periods
-                        MAX( 
-                            CASE
-                                WHEN h.value_float IS NOT NULL THEN h.value_float
-                                WHEN h.value_int IS NOT NULL THEN h.value_int::double precision
-                                WHEN h.value_bool IS NOT NULL THEN h.value_bool::int::double precision
-                                ELSE NULL
-                            END
-                        )
-                    FROM historian.historian h 
-                    JOIN historian.tag_lookup tl ON h.tag_id = tl.id
-                    WHERE tl.tag = ANY(%s) 
-                      AND h.ts >= %s 
-                      AND h.ts <= %s 
-                    GROUP BY b, tl.tag 
-                    ORDER BY b ASC
-                """
-                # Trust the original parameter order for safety:
-                params = (buck, tags, st_obj, et_obj) 
-            
-            # --- DEBUG FIX: LOG THE EXECUTED QUERY ---
-            print("\n--- DEBUG: HISTORIAN QUERY ---")
-            print(cur.mogrify(sql, params).decode('utf-8'))
-            print("------------------------------\n")
-            # --- END DEBUG FIX ---
-
             cur.execute(sql, params)
-            res = {t: [] for t in tags}
+            res = {t: None for t in tags}
             for r in cur.fetchall():
-                if r[2] is not None:
-                    res[r[1]].append({"ts": r[0].isoformat(), "value": r[2]})
+                if r[1] is None:
+                    res[r[0]] = {**_stats_row(r), "buckets": [] if bucket else None}
+                else:
+                    res[r[0]]["buckets"].append({"ts": r[1].isoformat(), **_stats_row(r)})
             return res
     except Exception as e:
-        print(f"🔴 Query Error: {e}")
+        print(f"🔴 Stats Query Error: {e}")
         return {"error": str(e)}
     finally:
         release_db_conn(conn)
@@ -674,6 +1663,84 @@ def write_tag_endpoint(req: TagWriteRequest):
     # If the write failed, raise a detailed error to the client
     raise HTTPException(status_code=500, detail={"status": status, "message": message})
 
+@app.get("/api/derived-tags")
+def get_derived_tags(user: User = Depends(get_current_active_engineer)):
+    return [{"name": n, "datatype": derived_engine.datatypes[n], "inputs": sorted(deps), "stateful": stateful,
+             "value": derived_engine.values.get(n)} for n, _, deps, stateful in derived_engine.order]
+
+@app.post("/api/derived-tags/reload")
+def reload_derived_tags(user: User = Depends(get_current_active_admin)):
+    load_derived_tags()
+    ensure_opc_nodes()
+    save_tag_snapshot()
+    return {"status": "success", "count": len(derived_engine.order)}
+
+@app.get("/api/alarms")
+def get_alarms(include_shelved: bool = False):
+    return {"seq": alarm_engine.seq, "alarms": alarm_engine.summary(include_shelved)}
+
+@app.get("/api/alarms/definitions", response_model=List[AlarmDefinition])
+def get_alarm_definitions(user: User = Depends(get_current_active_engineer)):
+    return alarm_engine.defs
+
+@app.post("/api/alarms/definitions/reload")
+def reload_alarm_definitions(user: User = Depends(get_current_active_admin)):
+    load_alarm_definitions()
+    save_tag_snapshot()
+    return {"status": "success", "count": len(alarm_engine.defs)}
+
+@app.post("/api/alarms/{alarm_id}/ack")
+def ack_alarm(alarm_id: int, user: User = Depends(get_current_active_engineer)):
+    if not alarm_engine.ack(alarm_id, user.username): raise HTTPException(404, "Alarm not found")
+    return {"status": "success"}
+
+@app.post("/api/alarms/{alarm_id}/shelve")
+def shelve_alarm(alarm_id: int, req: AlarmShelveRequest, user: User = Depends(get_current_active_engineer)):
+    if not alarm_engine.shelve(alarm_id, req.minutes, user.username): raise HTTPException(404, "Alarm not found")
+    return {"status": "success"}
+
+@app.post("/api/alarms/{alarm_id}/unshelve")
+def unshelve_alarm(alarm_id: int, user: User = Depends(get_current_active_engineer)):
+    if not alarm_engine.unshelve(alarm_id, user.username): raise HTTPException(404, "Alarm not found")
+    return {"status": "success"}
+
+@app.get("/api/alarms/journal")
+def get_alarm_journal(limit: int = Query(200, ge=1, le=5000), user: User = Depends(get_current_user)):
+    conn = None
+    try:
+        conn = get_db_conn()
+        with conn.cursor() as cur:
+            cur.execute("""SELECT ts, alarm_id, name, tag, event, value, severity, username
+                           FROM app.alarm_journal ORDER BY ts DESC LIMIT %s""", (limit,))
+            return [{"ts": r[0].isoformat(), "alarm_id": r[1], "name": r[2], "tag": r[3], "event": r[4],
+                     "value": r[5], "severity": r[6], "username": r[7]} for r in cur.fetchall()]
+    finally:
+        release_db_conn(conn)
+
+@app.get("/api/alarms/stream")
+async def alarm_stream(request: Request, last_event_id: Optional[str] = Header(None)):
+    # Server-Sent Events: clients subscribe once instead of polling /api/alarms.
+    # EventSource resends Last-Event-ID on reconnect, so nothing in the ring buffer is missed.
+    # Every connection starts with a full snapshot, so an id from an older boot
+    # (or one ahead of us) simply resumes from the current seq.
+    async def gen():
+        boot, _, last = (last_event_id or "").partition("-")
+        seq = alarm_engine.seq
+        if boot == ALARM_BOOT_ID and last.isdigit(): seq = min(int(last), alarm_engine.seq)
+        yield f"event: snapshot\ndata: {json.dumps(alarm_engine.summary())}\n\n"
+        idle = 0.0
+        while not stop_event.is_set() and not await request.is_disconnected():
+            for ev in alarm_engine.events_since(seq):
+                seq = ev["seq"]
+                yield f"id: {ALARM_BOOT_ID}-{seq}\nevent: alarm\ndata: {_alarm_event_json(ev)}\n\n"
+                idle = 0.0
+            if idle >= 15:
+                yield ": keepalive\n\n"
+                idle = 0.0
+            await asyncio.sleep(0.5)
+            idle += 0.5
+    return StreamingResponse(gen(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
 @app.get("/api/settings", response_model=List[Setting])
 def get_settings_endpoint(user: User = Depends(get_current_active_engineer)):
     conn = None